@@ -2,15 +2,34 @@ import runpod
 from runpod.serverless.utils import rp_upload
 import os
 import websocket
+import requests
+from requests.adapters import HTTPAdapter
 import base64
+try:
+    import pybase64 # SIMD-accelerated drop-in replacement for base64
+except ImportError:
+    pybase64 = base64
 import json
+import re
+try:
+    import orjson # Fast JSON encode/decode (dumps returns bytes)
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 import uuid
 import logging
 import urllib.request
 import urllib.parse
 import binascii # For Base64 error handling
 import time
+import random
+import socket
 import shutil # For file copying
+import errno
+from concurrent.futures import ThreadPoolExecutor
 # Logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,8 +38,111 @@ logger = logging.getLogger(__name__)
 server_address = os.getenv('SERVER_ADDRESS', '127.0.0.1')
 client_id = str(uuid.uuid4())
 
-# ComfyUI input directory path
+# WebSocket kept open across jobs (see get_ws)
+ws_connection = None
+# Seconds without a WebSocket message before checking the prompt history
+WS_RECV_TIMEOUT = 60
+
+# Keep-alive HTTP session reused for all ComfyUI API calls across jobs
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+# Shared pool for overlapping independent I/O within a job
+executor = ThreadPoolExecutor(max_workers=4)
+
+# ComfyUI input directory path (created once at startup, not per job)
 COMFYUI_INPUT_DIR = "/ComfyUI/input"
+os.makedirs(COMFYUI_INPUT_DIR, exist_ok=True)
+
+# Workflow file per LoRA pair count (index = number of LoRA pairs)
+WORKFLOW_BY_LORA_COUNT = (
+    "/wan22_nolora.json",
+    "/wan22_1lora.json",
+    "/wan22_2lora.json",
+    "/wan22_3lora.json",
+)
+
+# LoRA node ID mapping (LoRA node IDs differ in each workflow)
+LORA_NODE_MAPPING = {
+    1: {
+        "high": ("282",),
+        "low": ("286",)
+    },
+    2: {
+        "high": ("282", "339"),
+        "low": ("286", "337")
+    },
+    3: {
+        "high": ("282", "339", "340"),
+        "low": ("286", "337", "338")
+    }
+}
+
+# Workflow inputs set from the job input: (node ID, input name, job input key)
+PROMPT_PATCHES = (
+    ("846", "value", "length"),
+    ("246", "value", "prompt"),
+    ("835", "noise_seed", "seed"),
+    ("830", "cfg", "cfg"),
+    ("849", "value", "width"),
+    ("848", "value", "height"),
+)
+
+# Defaults for optional job input keys used in PROMPT_PATCHES
+JOB_INPUT_DEFAULTS = {"length": 81}
+
+# Data URI prefix of Base64 image input (media type and parameters end at the first comma)
+DATA_URI_PREFIX = re.compile(rb'data:[^,]{0,256},')
+
+# Chunk size used when Base64-encoding result videos (must be a multiple of 3)
+BASE64_CHUNK_SIZE = 3 * 1024 * 1024
+
+# Upload result videos to S3-compatible storage when a bucket is configured
+UPLOAD_TO_BUCKET = bool(os.getenv('BUCKET_ENDPOINT_URL'))
+
+# Buffer size used when streaming image data to disk
+COPY_BUFFER_SIZE = 1 << 20
+
+def stream_to_file(src, file_path):
+    """
+    Streams a readable file object into file_path.
+    Writes to a temporary file in the same directory first and renames it,
+    so ComfyUI never sees a partially written image.
+    """
+    tmp_path = f"{file_path}.part"
+    try:
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(src, f, COPY_BUFFER_SIZE)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def copy_file(src_path, file_path):
+    """
+    Copies src_path to file_path without passing data through userspace.
+    Uses os.copy_file_range and falls back to shutil.copyfile (sendfile).
+    Metadata is not copied - ComfyUI only needs the image data.
+    """
+    tmp_path = f"{file_path}.part"
+    try:
+        try:
+            with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+        except (AttributeError, OSError) as e:
+            logger.info(f"copy_file_range not available ({e}), using shutil.copyfile")
+            shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 def process_image_path(image_path, task_id):
     """
@@ -42,11 +164,9 @@ def process_image_path(image_path, task_id):
             filename = f"{task_id}_input{ext}"
             file_path = os.path.join(COMFYUI_INPUT_DIR, filename)
 
-            # Create directory if it doesn't exist
-            os.makedirs(COMFYUI_INPUT_DIR, exist_ok=True)
-
-            # Download image from URL
-            urllib.request.urlretrieve(image_path, file_path)
+            # Stream image from URL straight to disk
+            with urllib.request.urlopen(image_path, timeout=30) as response:
+                stream_to_file(response, file_path)
             logger.info(f"Downloaded image to: {file_path}")
             return filename  # ComfyUI only needs the filename within input directory
         except Exception as e:
@@ -63,12 +183,15 @@ def process_image_path(image_path, task_id):
     filename = f"{task_id}_input{ext}"
     file_path = os.path.join(COMFYUI_INPUT_DIR, filename)
 
-    # Create directory if it doesn't exist
-    os.makedirs(COMFYUI_INPUT_DIR, exist_ok=True)
-
-    # Copy file to ComfyUI input directory
-    shutil.copy2(image_path, file_path)
-    logger.info(f"Copied local file to: {file_path}")
+    # Hardlink into ComfyUI input directory (no data copy); copy in kernel across filesystems
+    try:
+        os.link(image_path, file_path)
+        logger.info(f"Linked local file to: {file_path}")
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EEXIST):
+            raise
+        copy_file(image_path, file_path)
+        logger.info(f"Copied local file to: {file_path}")
 
     return filename  # ComfyUI only needs the filename within input directory
 
@@ -83,20 +206,24 @@ def process_image_base64(image_base64, task_id):
         raise ValueError("image_base64 must be a string")
 
     try:
+        # Encode once and slice with a memoryview, so the payload is not copied again
+        raw = image_base64.encode('ascii')
+        body = memoryview(raw)
+
         # Remove data URI prefix if present (e.g., "data:image/jpeg;base64,")
-        if image_base64.startswith('data:'):
-            image_base64 = image_base64.split(',', 1)[1]
+        match = DATA_URI_PREFIX.match(raw)
+        if match:
+            body = body[match.end():]
+        elif raw.startswith(b'data:'):
+            raise ValueError("Invalid data URI prefix")
 
         # Attempt base64 decoding
-        decoded_data = base64.b64decode(image_base64, validate=True)
+        decoded_data = pybase64.b64decode(body, validate=True)
 
         # Save to file
         filename = f"{task_id}_input.jpg"
         file_path = os.path.join(COMFYUI_INPUT_DIR, filename)
 
-        # Create directory if it doesn't exist
-        os.makedirs(COMFYUI_INPUT_DIR, exist_ok=True)
-
         with open(file_path, 'wb') as f:
             f.write(decoded_data)
 
@@ -110,55 +237,190 @@ def queue_prompt(prompt):
     url = f"http://{server_address}:8188/prompt"
     logger.info(f"Queueing prompt to: {url}")
     p = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(p).encode('utf-8')
-    req = urllib.request.Request(url, data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+    data = json_dumps(p)
+    response = session.post(url, data=data, headers={"Content-Type": "application/json"})
+    response.raise_for_status()
+    return json_loads(response.content)
 
 def get_image(filename, subfolder, folder_type):
     url = f"http://{server_address}:8188/view"
     logger.info(f"Getting image from: {url}")
     data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    url_values = urllib.parse.urlencode(data)
-    with urllib.request.urlopen(f"{url}?{url_values}") as response:
-        return response.read()
+    response = session.get(url, params=data)
+    response.raise_for_status()
+    return response.content
 
 def get_history(prompt_id):
     url = f"http://{server_address}:8188/history/{prompt_id}"
     logger.info(f"Getting history from: {url}")
-    with urllib.request.urlopen(url) as response:
-        return json.loads(response.read())
+    response = session.get(url)
+    response.raise_for_status()
+    return json_loads(response.content)
+
+def connect_ws():
+    ws_url = f"ws://{server_address}:8188/ws?clientId={client_id}"
+    logger.info(f"Connecting to WebSocket: {ws_url}")
 
-def get_videos(ws, prompt):
+    ws = websocket.WebSocket()
+    # Attempt WebSocket connection (max 3 minutes)
+    # Retries with jittered exponential backoff: 100ms, 200ms, 400ms ... capped at 2s
+    end_time = time.monotonic() + 180
+    delay = 0.1
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            ws.connect(ws_url, timeout=5)
+            logger.info(f"WebSocket connection successful (attempt {attempt})")
+            break
+        except Exception as e:
+            logger.warning(f"WebSocket connection failed (attempt {attempt}): {e}")
+            if time.monotonic() >= end_time:
+                raise Exception("WebSocket connection timeout (3 minutes)")
+            time.sleep(delay + random.random() * 0.05)
+            delay = min(2.0, delay * 2)
+    ws.settimeout(WS_RECV_TIMEOUT)
+    return ws
+
+def get_ws():
+    """
+    Returns the WebSocket shared across jobs, reconnecting only if it was closed.
+    """
+    global ws_connection
+    if ws_connection is not None and ws_connection.connected:
+        try:
+            ws_connection.ping()
+            return ws_connection
+        except Exception as e:
+            logger.warning(f"WebSocket ping failed, reconnecting: {e}")
+            ws_connection.close()
+    ws_connection = connect_ws()
+    return ws_connection
+
+def get_videos(ws, prompt, task_id):
     prompt_id = queue_prompt(prompt)['prompt_id']
     output_videos = {}
     while True:
-        out = ws.recv()
-        if isinstance(out, str):
-            message = json.loads(out)
-            if message['type'] == 'executing':
-                data = message['data']
-                if data['node'] is None and data['prompt_id'] == prompt_id:
-                    break
-        else:
+        try:
+            # recv_data returns the raw opcode and payload without decoding text frames
+            opcode, frame = ws.recv_data()
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                ws.shutdown()
+                raise websocket.WebSocketConnectionClosedException("Connection closed by ComfyUI")
+        except websocket.WebSocketTimeoutException:
+            # No message for a while - check whether the prompt already finished
+            if prompt_id in get_history(prompt_id):
+                break
+            continue
+        except websocket.WebSocketConnectionClosedException:
+            logger.warning("WebSocket connection closed during job, reconnecting")
+            ws = get_ws()
+            # Completion message may have been lost while disconnected
+            if prompt_id in get_history(prompt_id):
+                break
+            continue
+        # Skip binary preview frames and any message that is not 'executing'
+        # without paying for a JSON parse. The result video is encoded by
+        # VHS_VideoCombine and read from disk below; SaveImageWebsocket only
+        # streams individual image frames, so binary frames are never output.
+        if opcode != websocket.ABNF.OPCODE_TEXT:
+            continue
+        if b'"executing"' not in frame:
             continue
+        message = json_loads(frame)
+        if message['type'] == 'executing':
+            data = message['data']
+            if data['node'] is None and data['prompt_id'] == prompt_id:
+                break
 
     history = get_history(prompt_id)[prompt_id]
+    # Upload/encode all output videos concurrently
+    video_futures = {}
+    video_paths = []
     for node_id in history['outputs']:
         node_output = history['outputs'][node_id]
-        videos_output = []
-        if 'gifs' in node_output:
-            for video in node_output['gifs']:
-                # Read file directly using fullpath and encode to base64
-                with open(video['fullpath'], 'rb') as f:
-                    video_data = base64.b64encode(f.read()).decode('utf-8')
-                videos_output.append(video_data)
-        output_videos[node_id] = videos_output
+        video_futures[node_id] = []
+        for video in node_output.get('gifs', []):
+            video_futures[node_id].append(executor.submit(encode_video, video['fullpath'], task_id))
+            video_paths.append(video['fullpath'])
+
+    for node_id, futures in video_futures.items():
+        output_videos[node_id] = [future.result() for future in futures]
+
+    # Video data is in hand - delete the files in the background
+    executor.submit(remove_files, video_paths)
 
     return output_videos
 
+def encode_video(video_path, task_id):
+    """
+    Returns the presigned URL of the uploaded video when a bucket is configured,
+    otherwise the Base64 encoded video data.
+    """
+    if UPLOAD_TO_BUCKET:
+        return rp_upload.upload_file_to_bucket(
+            file_name=f"{task_id}_{os.path.basename(video_path)}",
+            file_location=video_path,
+        )
+    # Read file in chunks and encode to base64 without holding the raw video in memory
+    # Chunk size is a multiple of 3, so chunks encode without intermediate padding
+    encoded = bytearray()
+    with open(video_path, 'rb') as f:
+        while chunk := f.read(BASE64_CHUNK_SIZE):
+            encoded += pybase64.b64encode(chunk)
+    return encoded.decode('ascii')
+
+def remove_files(paths):
+    """
+    Deletes per-job input/output files so they don't accumulate on a warm worker.
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Failed to remove {path}: {e}")
+
+def wait_for_port(host, port, deadline=180):
+    """
+    Waits until the ComfyUI server accepts TCP connections (max 3 minutes).
+    Retries with exponential backoff: 50ms, 100ms, 200ms ... capped at 1s.
+    """
+    logger.info(f"Checking connection to: {host}:{port}")
+    end_time = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        attempt += 1
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(0.2)
+            try:
+                result = s.connect_ex((host, port))
+            except OSError as e:
+                result = e
+        if result == 0:
+            logger.info(f"Connection successful (attempt {attempt})")
+            return
+        if time.monotonic() >= end_time:
+            raise Exception("Cannot connect to ComfyUI server. Please check if the server is running.")
+        logger.warning(f"Connection failed (attempt {attempt}): {result}")
+        time.sleep(min(1.0, 0.05 * 2 ** min(attempt - 1, 5)))
+
+# Workflow cache: path -> (mtime_ns, workflow JSON bytes)
+workflow_cache = {}
+
 def load_workflow(workflow_path):
-    with open(workflow_path, 'r') as file:
-        return json.load(file)
+    """
+    Loads a workflow JSON, reusing the cached copy while the file is unchanged.
+    The cache holds a serialized blob so every call returns a fresh dict
+    that the handler can mutate freely.
+    """
+    mtime_ns = os.stat(workflow_path).st_mtime_ns
+    cached = workflow_cache.get(workflow_path)
+    if cached is None or cached[0] != mtime_ns:
+        with open(workflow_path, 'rb') as file:
+            data = file.read()
+        workflow_cache[workflow_path] = (mtime_ns, data)
+        return json_loads(data)
+    return json_loads(cached[1])
 
 def handler(job):
     job_input = job.get("input", {})
@@ -178,53 +440,44 @@ def handler(job):
     if image_path_input and image_base64_input:
         return {"error": "Please provide either image_path or image_base64, not both"}
 
+    # Check LoRA settings - process as array
+    lora_pairs = job_input.get("lora_pairs", [])
+
+    # Select appropriate workflow file based on LoRA count
+    if len(lora_pairs) > 3:
+        logger.warning(f"LoRA count is {len(lora_pairs)}. Maximum 3 are supported. Limiting to 3.")
+        lora_pairs = lora_pairs[:3]  # Use only first 3
+    lora_count = len(lora_pairs)
+    workflow_file = WORKFLOW_BY_LORA_COUNT[lora_count]
+    logger.info(f"Using {lora_count} LoRA pair(s) workflow: {workflow_file}")
+
+    # Image download, workflow load and the ComfyUI readiness check are
+    # independent I/O steps, so run them concurrently
+    if image_base64_input:
+        image_future = executor.submit(process_image_base64, image_base64_input, task_id)
+    else:
+        image_future = executor.submit(process_image_path, image_path_input, task_id)
+    workflow_future = executor.submit(load_workflow, workflow_file)
+    server_future = executor.submit(wait_for_port, server_address, 8188)
+
     try:
+        image_filename = image_future.result()
         if image_base64_input:
-            # Process Base64 image
-            image_filename = process_image_base64(image_base64_input, task_id)
             logger.info(f"Processed base64 image: {image_filename}")
         else:
-            # Process image path (URL or local file)
-            image_filename = process_image_path(image_path_input, task_id)
             logger.info(f"Processed image path: {image_filename}")
     except Exception as e:
         return {"error": f"Failed to process image: {e}"}
 
-    # Check LoRA settings - process as array
-    lora_pairs = job_input.get("lora_pairs", [])
+    prompt = workflow_future.result()
 
-    # Select appropriate workflow file based on LoRA count
-    lora_count = len(lora_pairs)
-    if lora_count == 0:
-        workflow_file = "/wan22_nolora.json"
-        logger.info("Using no LoRA workflow")
-    elif lora_count == 1:
-        workflow_file = "/wan22_1lora.json"
-        logger.info("Using 1 LoRA pair workflow")
-    elif lora_count == 2:
-        workflow_file = "/wan22_2lora.json"
-        logger.info("Using 2 LoRA pairs workflow")
-    elif lora_count == 3:
-        workflow_file = "/wan22_3lora.json"
-        logger.info("Using 3 LoRA pairs workflow")
-    else:
-        logger.warning(f"LoRA count is {lora_count}. Maximum 3 are supported. Limiting to 3.")
-        lora_count = 3
-        workflow_file = "/wan22_3lora.json"
-        lora_pairs = lora_pairs[:3]  # Use only first 3
-    
-    prompt = load_workflow(workflow_file)
-    
-    length = job_input.get("length", 81)
     steps = job_input.get("steps", 10)
 
     prompt["260"]["inputs"]["image"] = image_filename
-    prompt["846"]["inputs"]["value"] = length
-    prompt["246"]["inputs"]["value"] = job_input["prompt"]
-    prompt["835"]["inputs"]["noise_seed"] = job_input["seed"]
-    prompt["830"]["inputs"]["cfg"] = job_input["cfg"]
-    prompt["849"]["inputs"]["value"] = job_input["width"]
-    prompt["848"]["inputs"]["value"] = job_input["height"]
+    for node_id, input_name, key in PROMPT_PATCHES:
+        # Optional keys fall back to their default; required keys raise KeyError
+        value = job_input[key] if key in job_input else JOB_INPUT_DEFAULTS[key]
+        prompt[node_id]["inputs"][input_name] = value
 
     # Apply step settings
     if "834" in prompt:
@@ -236,23 +489,7 @@ def handler(job):
 
     # Apply LoRA settings
     if lora_count > 0:
-        # LoRA node ID mapping (LoRA node IDs differ in each workflow)
-        lora_node_mapping = {
-            1: {
-                "high": ["282"],
-                "low": ["286"]
-            },
-            2: {
-                "high": ["282", "339"],
-                "low": ["286", "337"]
-            },
-            3: {
-                "high": ["282", "339", "340"],
-                "low": ["286", "337", "338"]
-            }
-        }
-        
-        current_mapping = lora_node_mapping[lora_count]
+        current_mapping = LORA_NODE_MAPPING[lora_count]
         
         for i, lora_pair in enumerate(lora_pairs):
             if i < lora_count:
@@ -277,45 +514,18 @@ def handler(job):
                         prompt[low_node_id]["inputs"]["strength_model"] = lora_low_weight
                         logger.info(f"LoRA {i+1} LOW applied: {lora_low} with weight {lora_low_weight}")
 
-    ws_url = f"ws://{server_address}:8188/ws?clientId={client_id}"
-    logger.info(f"Connecting to WebSocket: {ws_url}")
-
-    # First, check if HTTP connection is available
-    http_url = f"http://{server_address}:8188/"
-    logger.info(f"Checking HTTP connection to: {http_url}")
+    # First, make sure the ComfyUI server is accepting connections
+    server_future.result()
 
-    # Check HTTP connection (max 3 minutes)
-    max_http_attempts = 180
-    for http_attempt in range(max_http_attempts):
-        try:
-            response = urllib.request.urlopen(http_url, timeout=5)
-            logger.info(f"HTTP connection successful (attempt {http_attempt+1})")
-            break
-        except Exception as e:
-            logger.warning(f"HTTP connection failed (attempt {http_attempt+1}/{max_http_attempts}): {e}")
-            if http_attempt == max_http_attempts - 1:
-                raise Exception("Cannot connect to ComfyUI server. Please check if the server is running.")
-            time.sleep(1)
-
-    ws = websocket.WebSocket()
-    # Attempt WebSocket connection (max 3 minutes)
-    max_attempts = int(180/5)  # 3 minutes (attempt every 5 seconds)
-    for attempt in range(max_attempts):
-        try:
-            ws.connect(ws_url)
-            logger.info(f"WebSocket connection successful (attempt {attempt+1})")
-            break
-        except Exception as e:
-            logger.warning(f"WebSocket connection failed (attempt {attempt+1}/{max_attempts}): {e}")
-            if attempt == max_attempts - 1:
-                raise Exception("WebSocket connection timeout (3 minutes)")
-            time.sleep(5)
-    videos = get_videos(ws, prompt)
-    ws.close()
+    ws = get_ws()
+    videos = get_videos(ws, prompt, task_id)
+    executor.submit(remove_files, [os.path.join(COMFYUI_INPUT_DIR, image_filename)])
 
     # Handle case when no videos are found
     for node_id in videos:
         if videos[node_id]:
+            if UPLOAD_TO_BUCKET:
+                return {"video_url": videos[node_id][0]}
             return {"video": videos[node_id][0]}
 
     return {"error": "No videos found."}